@@ -1,61 +1,126 @@
 # thanks to https://github.com/openai/whisper for a good chunk of MIT licensed code
 
 import sys
+import math
 import pathlib
 import base64
 import multiprocessing
 import numpy as np
-from typing import Optional
+from typing import Optional, Tuple, List
 from extra.utils import download_file
 from tinygrad.nn.state import torch_load, load_state_dict
-from tinygrad.helpers import getenv
+from tinygrad.helpers import getenv, dtypes, CI
+from tinygrad.jit import TinyJit
 import tinygrad.nn as nn
 from tinygrad.tensor import Tensor
 import itertools
 import librosa
 
+JIT = getenv("JIT", 0 if CI else 1)
+# FLASH_BLOCK=64 runs long self attention as the blocked loop below, off by default until it's measured to beat the fused softmax
+FLASH_BLOCK = getenv("FLASH_BLOCK", 0)
+
+# https://arxiv.org/abs/2205.14135
+def flash_attention(q:Tensor, k:Tensor, v:Tensor, mask:Optional[Tensor]=None, block_size:int=64) -> Tensor:
+  # walk k/v one block at a time keeping a running max (m) and sum (l) per query row, so the full (n_ctx, n_kv) scores are never materialized
+  q = q * q.shape[-1] ** -0.5
+  m = Tensor.full((*q.shape[:-1], 1), float("-inf"))
+  l, o = Tensor.zeros(*q.shape[:-1], 1), Tensor.zeros(*q.shape)
+  for i in range(0, k.shape[-2], block_size):
+    s = q @ k[:, :, i:i+block_size].transpose(-2, -1)
+    if mask is not None: s = s + mask[..., i:i+block_size]
+    m_new = m.maximum(s.max(-1, keepdim=True))
+    p, c = (s - m_new).exp(), (m - m_new).exp()
+    m, l, o = m_new, l * c + p.sum(-1, keepdim=True), o * c + p @ v[:, :, i:i+block_size]
+  return o / l
+
+class AbsmaxQuantizedLinear:
+  def __init__(self, in_features, out_features, bias=True):
+    self.weight = Tensor.ones(out_features, in_features, dtype=dtypes.int8)
+    self.scale = Tensor.ones(out_features)
+    self.bias = Tensor.zeros(out_features) if bias else None
+
+  def __call__(self, x):
+    # int8 weights are dequantized inside the matmul, the activations (and layernorm/softmax) stay float32
+    return x.linear(self.weight.cast(dtypes.float32).T*self.scale, self.bias)
+
+  @staticmethod
+  def quantize(tensors):
+    new_tensors = {}
+    for name,v in tensors.items():
+      # the decoder linears, layernorm weights are 1d and the embeddings aren't in the blocks
+      if name.startswith("decoder.blocks.") and name.endswith(".weight") and len(v.shape) == 2:
+        scale = v.abs().max(axis=1) / 127.0
+        int8_weight = (v.T/scale).T.cast(dtype=dtypes.int8)
+        new_tensors[name] = int8_weight
+        new_tensors[name.replace('weight', 'scale')] = scale
+      else:
+        new_tensors[name] = v
+    return new_tensors
+
 # TODO: you have written this fifteen times
 class MultiHeadAttention:
-  def __init__(self, n_state, n_head):
+  def __init__(self, n_state, n_head, kv_caching:Optional[str]=None, max_self_attn_cache_len:int=0, linear=nn.Linear):
     self.n_head = n_head
-    self.query = nn.Linear(n_state, n_state)
-    self.key = nn.Linear(n_state, n_state, bias=False)
-    self.value = nn.Linear(n_state, n_state)
-    self.out = nn.Linear(n_state, n_state)
+    self.query = linear(n_state, n_state)
+    self.key = linear(n_state, n_state, bias=False)
+    self.value = linear(n_state, n_state)
+    self.out = linear(n_state, n_state)
+    # "self" keeps a static (n_batch, max_self_attn_cache_len, n_state) cache of past keys/values, "cross" keeps the encoder output's
+    self.kv_caching, self.max_self_attn_cache_len = kv_caching, max_self_attn_cache_len
 
-  def __call__(self, x:Tensor, xa:Optional[Tensor]=None, mask:Optional[Tensor]=None):
+  def __call__(self, x:Tensor, xa:Optional[Tensor]=None, mask:Optional[Tensor]=None, pos:Optional[Tensor]=None):
     q = self.query(x)
-    k = self.key(xa or x)
-    v = self.value(xa or x)
-    wv, qk = self.qkv_attention(q, k, v, mask)
-    # NOTE: we aren't returning qk
-    return self.out(wv)
+    if self.kv_caching == "cross":
+      # cross attention k/v only depend on the encoder output, which is fixed while decoding
+      if xa is not None: self.update_cache(self.key(xa), self.value(xa))
+      k, v = self.cache_k, self.cache_v
+    else:
+      k = self.key(x if xa is None else xa)
+      v = self.value(x if xa is None else xa)
+      if self.kv_caching == "self":
+        if pos is None:
+          # the prompt goes at the start of the cache
+          padding = ((0, 0), (0, self.max_self_attn_cache_len - x.shape[1]), (0, 0))
+          self.update_cache(k.pad(padding), v.pad(padding))
+        else:
+          # one new token is written at pos and attends over the whole (masked) cache, so the shapes never change
+          at_pos = (Tensor.arange(self.max_self_attn_cache_len) == pos).reshape(1, -1, 1)
+          k, v = self.update_cache(at_pos.where(k, self.cache_k), at_pos.where(v, self.cache_v))
+    return self.out(self.qkv_attention(q, k, v, mask))
+
+  def update_cache(self, k:Tensor, v:Tensor) -> Tuple[Tensor, Tensor]:
+    # NOTE: write into the existing buffers if we can, the jitted decoder step reads from them
+    if hasattr(self, "cache_k") and self.cache_k.shape == k.shape:
+      self.cache_k.assign(k.contiguous())
+      self.cache_v.assign(v.contiguous())
+    else:
+      self.cache_k, self.cache_v = k.contiguous(), v.contiguous()
+    return self.cache_k.realize(), self.cache_v.realize()
 
   def qkv_attention(self, q, k, v, mask=None):
-    n_batch, n_ctx, n_state = q.shape
-    scale = (n_state // self.n_head) ** -0.25
-    q = q.reshape(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3) * scale
-    k = k.reshape(*k.shape[:2], self.n_head, -1).permute(0, 2, 3, 1) * scale
-    v = v.reshape(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
-    qk = q @ k
-    if mask is not None: qk = qk + mask[:n_ctx, :n_ctx]
-    w = qk.softmax(-1)
-    return (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2), qk.detach()
+    q, k, v = [y.reshape(*y.shape[:2], self.n_head, -1).permute(0, 2, 1, 3) for y in (q, k, v)]
+    # NOTE: qk, the mask add and the softmax stay one lazy expression, don't realize or return qk in between
+    # with a few queries the scores are small anyway, only long (encoder) self attention is worth the block loop
+    if FLASH_BLOCK and q.shape[2] > FLASH_BLOCK: attn = flash_attention(q, k, v, mask, block_size=FLASH_BLOCK)
+    else: attn = Tensor.scaled_dot_product_attention(q, k, v, mask)
+    return attn.permute(0, 2, 1, 3).flatten(start_dim=2)
 
 class ResidualAttentionBlock:
-  def __init__(self, n_state, n_head, cross_attention=False):
-    self.attn = MultiHeadAttention(n_state, n_head)
+  def __init__(self, n_state, n_head, cross_attention=False, max_self_attn_cache_len=0, linear=nn.Linear):
+    self.attn = MultiHeadAttention(n_state, n_head, "self" if max_self_attn_cache_len else None, max_self_attn_cache_len, linear=linear)
     self.attn_ln = nn.LayerNorm(n_state)
 
-    self.cross_attn = MultiHeadAttention(n_state, n_head) if cross_attention else None
+    self.cross_attn = MultiHeadAttention(n_state, n_head, "cross" if max_self_attn_cache_len else None, linear=linear) if cross_attention else None
     self.cross_attn_ln = nn.LayerNorm(n_state) if cross_attention else None
 
-    self.mlp = [nn.Linear(n_state, n_state*4), Tensor.gelu, nn.Linear(n_state*4, n_state)]
+    self.mlp = [linear(n_state, n_state*4), Tensor.gelu, linear(n_state*4, n_state)]
     self.mlp_ln = nn.LayerNorm(n_state)
 
-  def __call__(self, x, xa=None, mask=None):
-    x = x + self.attn(self.attn_ln(x), mask=mask)
+  def __call__(self, x, xa=None, mask=None, pos=None):
+    x = x + self.attn(self.attn_ln(x), mask=mask, pos=pos)
     if self.cross_attn: x = x + self.cross_attn(self.cross_attn_ln(x), xa)
+    # NOTE: keep the mlp one lazy expression, the bias add and (tanh form) gelu fuse into the first linear's kernel
     x = x + self.mlp_ln(x).sequential(self.mlp)
     return x
 
@@ -66,6 +131,8 @@ class AudioEncoder:
     self.blocks = [ResidualAttentionBlock(n_audio_state, n_audio_head) for _ in range(n_audio_layer)]
     self.ln_post = nn.LayerNorm(n_audio_state)
     self.positional_embedding = Tensor.empty(n_audio_ctx, n_audio_state)
+    self.n_audio_ctx = n_audio_ctx
+    self.encode_jitted, self.encode_shape = TinyJit(lambda x: self(x).realize()), None
 
   def __call__(self, x):
     x = self.conv1(x).gelu()
@@ -76,32 +143,49 @@ class AudioEncoder:
     x = self.ln_post(x)
     return x
 
+  def encode(self, x:Tensor) -> Tensor:
+    # a full 30 second window replays from the jit (recaptured if the batch changes), shorter (live) audio runs at its own length
+    if not JIT or x.shape[-1] != 2 * self.n_audio_ctx: return self(x).realize()
+    if self.encode_shape != x.shape: self.encode_jitted, self.encode_shape = TinyJit(lambda x: self(x).realize()), x.shape
+    return self.encode_jitted(x)
+
 class TextDecoder:
-  def __init__(self, n_vocab, n_text_ctx, n_text_state, n_text_head, n_text_layer, **_):
+  def __init__(self, n_vocab, n_text_ctx, n_text_state, n_text_head, n_text_layer, linear=nn.Linear, **_):
+    self.n_text_ctx = n_text_ctx
     self.token_embedding = nn.Embedding(n_vocab, n_text_state)
     self.positional_embedding = Tensor.empty(n_text_ctx, n_text_state)
-    self.blocks = [ResidualAttentionBlock(n_text_state, n_text_head, cross_attention=True) for _ in range(n_text_layer)]
+    self.blocks = [ResidualAttentionBlock(n_text_state, n_text_head, cross_attention=True, max_self_attn_cache_len=n_text_ctx, linear=linear) for _ in range(n_text_layer)]
     self.ln = nn.LayerNorm(n_text_state)
-    #mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
-
-  def __call__(self, x, xa):
-    offset = 0
-    x = self.token_embedding(x) + self.positional_embedding[offset : offset + x.shape[-1]]
-
-    seqlen, start_pos = x.shape[1], 0
+    self.step_jitted, self.cache_shape = TinyJit(self.step), None
 
-    mask = np.full((1, 1, seqlen, start_pos + seqlen), float("-inf"), dtype=np.float32)
-    mask = np.triu(mask, k=start_pos + 1)  # TODO: this is hard to do in tinygrad
-    mask = Tensor(mask)
+  def __call__(self, x:Tensor, xa:Tensor, past_len:int=0):
+    # past_len=0 runs the whole prompt and fills the kv caches, after that x is the single token at position past_len
+    if past_len == 0: return self.prefill(x, xa)
+    assert x.shape[1] == 1, f"only one token at a time can follow the prompt, got {x.shape[1]}"
+    return (self.step_jitted if JIT else self.step)(x, Tensor([past_len]))
 
+  def prefill(self, x:Tensor, xa:Tensor) -> Tensor:
+    # the jitted step is bound to the cache buffers, which get reallocated if the batch or the audio shape changes
+    if self.cache_shape != (x.shape[0], xa.shape): self.step_jitted, self.cache_shape = TinyJit(self.step), (x.shape[0], xa.shape)
+    seqlen = x.shape[-1]
+    x = self.token_embedding(x) + self.positional_embedding[:seqlen]
+    # NOTE: built on first use like nn.Embedding's vocab_counter, so it stays out of the state dict
+    if not hasattr(self, "mask"): self.mask = Tensor.full((self.n_text_ctx, self.n_text_ctx), float("-inf")).triu(1).realize()
+    mask = self.mask[:seqlen, :seqlen]
     for block in self.blocks: x = block(x, xa, mask)
-    x = self.ln(x)
-    return x @ self.token_embedding.weight.T
+    return (self.ln(x) @ self.token_embedding.weight.T).realize()
+
+  def step(self, x:Tensor, pos:Tensor) -> Tensor:
+    at_pos = (Tensor.arange(self.n_text_ctx) == pos).reshape(1, 1, -1)
+    x = self.token_embedding(x) + at_pos @ self.positional_embedding
+    mask = (Tensor.arange(self.n_text_ctx) > pos).where(float("-inf"), 0).reshape(1, -1)
+    for block in self.blocks: x = block(x, mask=mask, pos=pos)
+    return (self.ln(x) @ self.token_embedding.weight.T).realize()
 
 class Whisper:
-  def __init__(self, dims):
+  def __init__(self, dims, linear=nn.Linear):
     self.encoder = AudioEncoder(**dims)
-    self.decoder = TextDecoder(**dims)
+    self.decoder = TextDecoder(**dims, linear=linear)
 
   def __call__(self, mel:Tensor, tokens:Tensor):
     return self.decoder(tokens, self.encoder(mel))
@@ -109,16 +193,34 @@ class Whisper:
 RATE = 16000
 CHUNK = 1600
 RECORD_SECONDS = 10
+N_FFT = 400
+HOP_LENGTH = 160
+N_MELS = 80
+N_SAMPLES = RATE * 30
+# periodic hann, same as librosa/torch.stft
+WINDOW = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+MEL_FILTERS = librosa.filters.mel(sr=RATE, n_fft=N_FFT, n_mels=N_MELS).astype(np.float32)
+
+def stft(waveform:np.ndarray) -> np.ndarray:
+  # centered frames like librosa.stft, but all of them go through one vectorized rfft
+  waveform = np.pad(waveform, [(0, 0)] * (waveform.ndim - 1) + [(N_FFT // 2, N_FFT // 2)], mode="reflect")
+  frames = np.lib.stride_tricks.sliding_window_view(waveform, N_FFT, axis=-1)[..., ::HOP_LENGTH, :]
+  return np.fft.rfft(frames * WINDOW, axis=-1).swapaxes(-1, -2)
+
+def split_windows(waveform:np.ndarray, overlap:int=0) -> List[np.ndarray]:
+  # whisper only sees 30 seconds at a time, longer audio is cut into windows overlapping by overlap samples
+  # NOTE: the texts of the windows are just concatenated, with an overlap the words at the boundary show up twice
+  return [waveform[i:i+N_SAMPLES] for i in range(0, max(len(waveform) - overlap, 1), N_SAMPLES - overlap)]
 
-def prep_audio(waveform=None, sr=RATE) -> Tensor:
-  N_FFT = 400
-  HOP_LENGTH = 160
-  N_MELS = 80
+def prep_audio(waveform=None, sr=RATE, pad=True) -> Tensor:
   if waveform is None: waveform = np.zeros(N_FFT, dtype=np.float32)
-  stft = librosa.stft(waveform, n_fft=N_FFT, hop_length=HOP_LENGTH, window='hann', dtype=np.float32)
-  magnitudes = stft[..., :-1] ** 2
-  mel_spec = librosa.filters.mel(sr=sr, n_fft=N_FFT, n_mels=N_MELS) @ magnitudes
-  log_spec = np.log10(np.clip(mel_spec, 1e-10, mel_spec.max() + 1e8))
+  # pad or trim to whisper's 30 second window so the encoder always sees the same shape, pad=False only trims
+  waveform = waveform[..., :N_SAMPLES]
+  if pad: waveform = np.pad(waveform, [(0, 0)] * (waveform.ndim - 1) + [(0, N_SAMPLES - waveform.shape[-1])])
+  # only the rfft runs on the cpu, the mel matmul and the log are lazy ops that get scheduled together with the encoder
+  magnitudes = Tensor(np.abs(stft(waveform)[..., :-1]).astype(np.float32) ** 2)
+  mel_spec = Tensor(MEL_FILTERS if sr == RATE else librosa.filters.mel(sr=sr, n_fft=N_FFT, n_mels=N_MELS).astype(np.float32)) @ magnitudes
+  log_spec = mel_spec.maximum(1e-10).log() * (1 / math.log(10))
   log_spec = (log_spec + 4.0) / 4.0
   #print(waveform.shape, log_spec.shape)
   return log_spec
@@ -176,9 +278,8 @@ def listener(q):
   stream = p.open(format=pyaudio.paInt16, channels=1, rate=RATE, input=True, frames_per_buffer=CHUNK)
   print("listening")
   for _ in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-    data = stream.read(CHUNK)
-    waveform = ((np.frombuffer(data, np.int16)/32768).astype(np.float32)*3).reshape(1, -1)
-    q.put(waveform)
+    # NOTE: the raw int16 samples are sent, they get converted to float once right before prep_audio
+    q.put(np.frombuffer(stream.read(CHUNK), np.int16).reshape(1, -1))
   print("done listening")
 
 if __name__ == "__main__":
@@ -189,22 +290,40 @@ if __name__ == "__main__":
     fn = BASE / "whisper-tiny.en.pt"
     download_file("https://openaipublic.azureedge.net/main/whisper/models/d3dd57d32accea0b295c96e26691aa14d8822fac7d9d27d5dc00b4ca2826dd03/tiny.en.pt", fn)
   state = torch_load(fn)
-  model = Whisper(state['dims'])
-  load_state_dict(model, state['model_state_dict'])
+  # QUANTIZE=1 keeps the decoder linears in int8, at batch 1 every decoder step is bound by reading those weights
+  model = Whisper(state['dims'], linear=AbsmaxQuantizedLinear) if getenv("QUANTIZE") else Whisper(state['dims'])
+  weights = AbsmaxQuantizedLinear.quantize(state['model_state_dict']) if getenv("QUANTIZE") else state['model_state_dict']
+  load_state_dict(model, weights)
   enc = get_encoding(state['dims']['n_vocab'])
 
   if len(sys.argv) > 1:
-    # offline
-    waveform, sample_rate = librosa.load(sys.argv[1], normalize=True)
-    log_spec = prep_audio(waveform, sample_rate)
-    lst = [enc._special_tokens["<|startoftranscript|>"]]
-    dat = model.encoder(Tensor(log_spec)).realize()
-    for i in range(50):
-      out = model.decoder(Tensor([lst]), dat)
-      out.realize()
-      idx = out[0,-1].argmax().numpy()
-      lst.append(idx)
-      print(enc.decode(lst))
+    # offline, the 30 second windows of all the files are transcribed together in batches
+    windows, owners = [], []
+    for i, fn in enumerate(sys.argv[1:]):
+      windows += (w := split_windows(librosa.load(fn, sr=RATE)[0]))
+      owners += [i] * len(w)
+    sot, eot = enc._special_tokens["<|startoftranscript|>"], enc._special_tokens["<|endoftext|>"]
+    texts = [""] * (len(sys.argv) - 1)
+    # BATCH windows at a time go through the encoder and the decoder, so long files don't run out of device memory
+    BATCH = getenv("BATCH", 8)
+    for b in range(0, len(windows), BATCH):
+      batch = windows[b:b+BATCH]
+      log_spec = prep_audio(np.stack([np.pad(w, (0, N_SAMPLES - len(w))) for w in batch]), RATE)
+      dat = model.encoder.encode(log_spec)
+      past_len, tokens = 0, Tensor([[sot]] * len(batch))
+      # the tokens and the done flags stay on device, each step only copies out one element to check if every sequence is done
+      done, steps = Tensor.zeros(len(batch), 1), []
+      # a window can fill the whole text context, so only the context length bounds the steps
+      for _ in range(model.decoder.n_text_ctx - 1):
+        out = model.decoder(tokens, dat, past_len)
+        past_len += out.shape[1]
+        tokens = out[:, -1].argmax(-1, keepdim=True).realize()
+        steps.append(tokens)
+        done = done.maximum(tokens == eot).realize()
+        if done.min().numpy() == 1: break
+      for i, seq in zip(owners[b:b+BATCH], steps[0].cat(*steps[1:], dim=1).numpy().astype(int).tolist()):
+        texts[i] += enc.decode(seq[:seq.index(eot)] if eot in seq else seq)
+    for text in texts: print(text)
   else:
     # online
 
@@ -213,24 +332,34 @@ if __name__ == "__main__":
     p.daemon = True
     p.start()
 
-    lst = [enc._special_tokens["<|startoftranscript|>"]]
-    total = None
+    # NOTE: float32 like Tensor([lst]) would give, the embedding compares against a float arange
+    sot, eot = enc._special_tokens["<|startoftranscript|>"], enc._special_tokens["<|endoftext|>"]
+    tok_buf = np.zeros((1, model.decoder.n_text_ctx), dtype=np.float32)
+    tok_buf[0, 0], n_tok = sot, 1
+    past_len, dec = 0, enc.decode([sot])
+    # the listener records RECORD_SECONDS at most, chunks are copied into place instead of concatenating the whole history
+    total, n_samples = np.zeros((1, RATE * RECORD_SECONDS), dtype=np.int16), 0
     did_read = False
     for i in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-      while not q.empty() or total is None:
+      while not q.empty() or n_samples == 0:
         waveform = q.get()
-        if total is None: total = waveform
-        else: total = np.concatenate([total, waveform], axis=1)
+        total[:, n_samples:n_samples+waveform.shape[1]] = waveform
+        n_samples += waveform.shape[1]
         did_read = True
       if did_read:
-        last_total = total.shape[1]
-        log_spec = prep_audio(waveform=Tensor(total).numpy(), sr=RATE)
-        encoded_audio = model.encoder(Tensor(log_spec)).realize()
-      out = model.decoder(Tensor([lst]), encoded_audio).realize()
-      idx = out[0,-1].argmax().numpy()
-      lst.append(idx)
-      dec = enc.decode(lst)
+        # NOTE: not padded to 30 seconds, a full window through the encoder on every 100ms chunk costs far more than the jit saves
+        log_spec = prep_audio(waveform=total[:, :n_samples].astype(np.float32) * (3/32768), sr=RATE, pad=False)
+        encoded_audio = model.encoder.encode(log_spec)
+        # new audio changes every layer's inputs, so the whole prefix has to go through the decoder again
+        past_len, did_read = 0, False
+      if past_len == 0: tokens = Tensor(tok_buf[:, :n_tok])
+      out = model.decoder(tokens, encoded_audio, past_len).realize()
+      tokens = out[:, -1].argmax(-1, keepdim=True).realize()
+      idx = int(tokens.numpy()[0, 0])
+      past_len = n_tok
+      tok_buf[0, n_tok], n_tok = idx, n_tok + 1
+      dec += enc.decode([idx])
       print(dec) # DO NOT REMOVE PRINT. IT'S VERY IMPORTANT
-      if dec.endswith("<|endoftext|>"):
-        #total = total[:, 320*(len(lst)-1):]
-        lst = [enc._special_tokens["<|startoftranscript|>"]]
+      if idx == eot:
+        #total = total[:, 320*(n_tok-1):]
+        past_len, n_tok, dec = 0, 1, enc.decode([sot])
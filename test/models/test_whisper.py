@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import unittest
+from unittest.mock import patch
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.jit import JIT_SUPPORTED_DEVICE
+from tinygrad.ops import Device
+import librosa
+from examples.whisper import Whisper, flash_attention, stft, prep_audio, N_FFT, HOP_LENGTH, N_MELS, N_SAMPLES, RATE
+
+def librosa_log_spec(waveform):
+  waveform = np.pad(waveform, [(0, 0)] * (waveform.ndim - 1) + [(0, N_SAMPLES - waveform.shape[-1])])
+  magnitudes = np.abs(librosa.stft(waveform, n_fft=N_FFT, hop_length=HOP_LENGTH, window="hann", center=True, pad_mode="reflect")[..., :-1]) ** 2
+  mel_spec = librosa.filters.mel(sr=RATE, n_fft=N_FFT, n_mels=N_MELS) @ magnitudes
+  return (np.log10(np.maximum(mel_spec, 1e-10)) + 4.0) / 4.0
+
+class TestFlashAttention(unittest.TestCase):
+  def helper_test_attention(self, n_ctx, n_kv, mask=None, block_size=8):
+    q, k, v = Tensor.randn(2, 3, n_ctx, 16), Tensor.randn(2, 3, n_kv, 16), Tensor.randn(2, 3, n_kv, 16)
+    out = flash_attention(q, k, v, mask, block_size=block_size).numpy()
+    np.testing.assert_allclose(out, Tensor.scaled_dot_product_attention(q, k, v, mask).numpy(), atol=1e-5, rtol=1e-5)
+
+  def test_no_mask(self): self.helper_test_attention(20, 32)
+  def test_causal_mask(self): self.helper_test_attention(32, 32, Tensor.full((32, 32), float("-inf")).triu(1))
+  def test_partial_last_block(self): self.helper_test_attention(20, 29)
+  def test_causal_mask_partial_last_block(self): self.helper_test_attention(29, 29, Tensor.full((29, 29), float("-inf")).triu(1))
+  def test_fully_masked_blocks(self):
+    # every block after the first one is all -inf
+    self.helper_test_attention(4, 32, (Tensor.arange(32) >= 5).where(float("-inf"), 0).reshape(1, 32))
+
+class TestWhisperPrepAudio(unittest.TestCase):
+  def test_stft(self):
+    waveform = np.random.uniform(-1, 1, RATE).astype(np.float32)
+    expected = librosa.stft(waveform, n_fft=N_FFT, hop_length=HOP_LENGTH, window="hann", center=True, pad_mode="reflect")
+    np.testing.assert_allclose(stft(waveform), expected, atol=1e-3, rtol=1e-3)
+
+  def test_stft_batched(self):
+    waveform = np.random.uniform(-1, 1, (2, RATE)).astype(np.float32)
+    expected = librosa.stft(waveform, n_fft=N_FFT, hop_length=HOP_LENGTH, window="hann", center=True, pad_mode="reflect")
+    np.testing.assert_allclose(stft(waveform), expected, atol=1e-3, rtol=1e-3)
+
+  def test_prep_audio(self):
+    waveform = np.random.uniform(-1, 1, 2*RATE).astype(np.float32)
+    np.testing.assert_allclose(prep_audio(waveform).numpy(), librosa_log_spec(waveform), atol=1e-3, rtol=1e-3)
+
+  def test_prep_audio_batched(self):
+    waveform = np.random.uniform(-1, 1, (2, 2*RATE)).astype(np.float32)
+    log_spec = prep_audio(waveform).numpy()
+    self.assertEqual(log_spec.shape, (2, N_MELS, N_SAMPLES // HOP_LENGTH))
+    np.testing.assert_allclose(log_spec, librosa_log_spec(waveform), atol=1e-3, rtol=1e-3)
+
+  def test_prep_audio_no_pad(self):
+    waveform = np.random.uniform(-1, 1, 2*RATE).astype(np.float32)
+    log_spec = prep_audio(waveform, pad=False).numpy()
+    self.assertEqual(log_spec.shape, (N_MELS, 2*RATE // HOP_LENGTH))
+    # every frame that doesn't reach into the padding matches the padded version
+    np.testing.assert_allclose(log_spec[:, :-2], librosa_log_spec(waveform)[:, :log_spec.shape[-1]-2], atol=1e-3, rtol=1e-3)
+
+class TestWhisperStaticCache(unittest.TestCase):
+  def setUp(self):
+    dims = dict(n_mels=N_MELS, n_audio_ctx=8, n_audio_state=16, n_audio_head=2, n_audio_layer=1,
+                n_vocab=32, n_text_ctx=16, n_text_state=16, n_text_head=2, n_text_layer=2)
+    self.decoder = Whisper(dims).decoder
+    self.decoder.positional_embedding = Tensor.randn(dims["n_text_ctx"], dims["n_text_state"]).realize()
+    self.xa = Tensor.randn(2, dims["n_audio_ctx"], dims["n_text_state"]).realize()
+
+  def helper_test_steps(self, n_steps=6):
+    tokens = Tensor(np.random.randint(0, 32, (2, n_steps+1)).astype(np.float32))
+    expected = self.decoder(tokens, self.xa).numpy()
+    np.testing.assert_allclose(self.decoder(tokens[:, :1], self.xa).numpy(), expected[:, :1], atol=1e-4, rtol=1e-4)
+    for pos in range(1, n_steps+1):
+      np.testing.assert_allclose(self.decoder(tokens[:, pos:pos+1].contiguous(), self.xa, pos).numpy(), expected[:, pos:pos+1], atol=1e-4, rtol=1e-4)
+
+  def helper_test_static_cache(self, jit):
+    with patch("examples.whisper.JIT", jit):
+      self.helper_test_steps()
+      # the second prompt reuses the cache buffers (and the captured step when jitted)
+      self.helper_test_steps()
+
+  def test_static_cache(self): self.helper_test_static_cache(0)
+  @unittest.skipUnless(Device.DEFAULT in JIT_SUPPORTED_DEVICE, "needs JIT")
+  def test_static_cache_jit(self): self.helper_test_static_cache(1)
+
+if __name__ == '__main__':
+  unittest.main()